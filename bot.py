@@ -4,7 +4,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.fsm.strategy import FSMStrategy
-from aiogram.filters import Command, CommandStart
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, BufferedInputFile
 from aiogram.types.message import ContentType
 from aiogram.client.default import DefaultBotProperties
@@ -15,15 +15,14 @@ from aiogram.enums.update_type import UpdateType
 import io
 import logging
 import traceback
-import faiss
 import html
 from PIL import Image
 
 from config import *
-from utils.database import CelebDatabase
+from utils.generations import Generations, check_version, set_current_version
 
-from utils.face_embedding import preprocess, get_face_embedding
-from utils.search import find_closest
+from utils.face_embedding import preprocess, preprocess_all, get_face_embedding, get_face_embeddings
+from utils.search import find_closest, find_closest_batch
 
 
 logging.basicConfig(level=logging.INFO)
@@ -33,28 +32,14 @@ bot = Bot(
 dp = Dispatcher(storage=RedisStorage.from_url(REDIS_URL), fsm_strategy=FSMStrategy.CHAT)
 
 
-# loaded databases and indexes:
-class _Loaded:
-    male_lmdb_db = None
-    male_faiss_index = None
-
-    female_lmdb_db = None
-    female_faiss_index = None
-
-    nndb_male_lmdb_db = None
-    nndb_male_faiss_index = None
-
-    nndb_female_lmdb_db = None
-    nndb_female_faiss_index = None
-
-
-Loaded = _Loaded()
+# loaded databases and indexes, hot-swappable generations:
+Loaded = Generations()
 
 genders = ["Мужской", "Женский"]
 models = ["IMDB_WIKI", "NNDB_CELEBS"]
 
 
-def topk_text(gender_id, k, model_id, photo_id):
+def topk_text(gender_id, k, model_id, photo_id, multi=False):
     text = f"""Привет! Этот бот покажет тебе, на какую знаменитость ты похож.
 
 Выберите пол, сколько похожих фотографий выводить
@@ -65,6 +50,8 @@ def topk_text(gender_id, k, model_id, photo_id):
 
 <b>Количество похожих: {k}</b>
 
+<b>Режим: {'все лица на фото' if multi else 'одно лицо'}</b>
+
 <b>{'Фото загружено' if photo_id else 'Теперь загрузите фото'}</b>"""
     return text
 
@@ -73,7 +60,7 @@ def tick(i, j):
     return " ✅" if i == j else ""
 
 
-def topk_markup(gender_id, k, model_id, photo_id):
+def topk_markup(gender_id, k, model_id, photo_id, multi=False):
     inline_keyboard = [
         [
             types.InlineKeyboardButton(
@@ -91,6 +78,11 @@ def topk_markup(gender_id, k, model_id, photo_id):
             types.InlineKeyboardButton(text=str(i) + tick(i, k), callback_data=f"k{i}")
             for i in range(1, 6)
         ],
+        [
+            types.InlineKeyboardButton(
+                text="Все лица на фото" + tick(True, multi), callback_data="faces"
+            )
+        ],
     ]
     if photo_id:
         inline_keyboard.append(
@@ -111,19 +103,20 @@ async def start_command(message: types.Message, state: FSMContext):
     k = data.get("k", 5)
     model_id = data.get("model_id", 1)
     photo_id = data.get("photo_id")
+    multi = data.get("multi", False)
 
     reply = message.reply_to_message
     if photo_id is None and reply is not None and reply.photo is not None:
         photo_id = reply.photo[-1].file_id
 
     await message.answer(
-        topk_text(gender_id, k, model_id, photo_id),
+        topk_text(gender_id, k, model_id, photo_id, multi),
         message_effect_id=(
             "5046509860389126442" if message.chat.type == ChatType.PRIVATE else None
         ),
-        reply_markup=topk_markup(gender_id, k, model_id, photo_id),
+        reply_markup=topk_markup(gender_id, k, model_id, photo_id, multi),
     )
-    await state.set_data({"gender": gender_id, "k": k, "model_id": model_id, "photo_id": photo_id})
+    await state.set_data({"gender": gender_id, "k": k, "model_id": model_id, "photo_id": photo_id, "multi": multi})
 
 
 @dp.callback_query(F.data.startswith("g"))
@@ -135,14 +128,15 @@ async def select_gender(call: types.CallbackQuery, state: FSMContext):
     k = data.get("k", 5)
     model_id = data.get("model_id", 1)
     photo_id = data.get("photo_id")
+    multi = data.get("multi", False)
     if gender_id == old_gender_id:
         await call.answer("Пол не изменился")
         return
 
     await call.answer(f"Пол выставлен в {genders[gender_id]}")
     await call.message.edit_text(
-        topk_text(gender_id, k, model_id, photo_id),
-        reply_markup=topk_markup(gender_id, k, model_id, photo_id),
+        topk_text(gender_id, k, model_id, photo_id, multi),
+        reply_markup=topk_markup(gender_id, k, model_id, photo_id, multi),
     )
     await state.update_data({"gender": gender_id})
 
@@ -156,14 +150,15 @@ async def select_k(call: types.CallbackQuery, state: FSMContext):
     old_k = data.get("k", 5)
     model_id = data.get("model_id", 1)
     photo_id = data.get("photo_id")
+    multi = data.get("multi", False)
     if old_k == k:
         await call.answer("Количество похожих не изменилось")
         return
 
     await call.answer(f"Количество похожих: {k}")
     await call.message.edit_text(
-        topk_text(gender_id, k, model_id, photo_id),
-        reply_markup=topk_markup(gender_id, k, model_id, photo_id),
+        topk_text(gender_id, k, model_id, photo_id, multi),
+        reply_markup=topk_markup(gender_id, k, model_id, photo_id, multi),
     )
     await state.update_data({"k": k})
 
@@ -177,18 +172,35 @@ async def select_model(call: types.CallbackQuery, state: FSMContext):
     k = data.get("k", 5)
     old_model_id = data.get("model_id", 1)
     photo_id = data.get("photo_id")
+    multi = data.get("multi", False)
     if old_model_id == model_id:
         await call.answer("Модель не изменилась")
         return
 
     await call.answer(f"Выбрана модель: {models[model_id]}")
     await call.message.edit_text(
-        topk_text(gender_id, k, model_id, photo_id),
-        reply_markup=topk_markup(gender_id, k, model_id, photo_id),
+        topk_text(gender_id, k, model_id, photo_id, multi),
+        reply_markup=topk_markup(gender_id, k, model_id, photo_id, multi),
     )
     await state.update_data({"model_id": model_id})
 
 
+@dp.callback_query(F.data == "faces")
+async def select_faces(call: types.CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    gender_id = data.get("gender", 0)
+    k = data.get("k", 5)
+    model_id = data.get("model_id", 1)
+    photo_id = data.get("photo_id")
+    multi = not data.get("multi", False)
+
+    await call.answer("Ищем всех людей на фото" if multi else "Ищем одно лицо")
+    await call.message.edit_text(
+        topk_text(gender_id, k, model_id, photo_id, multi),
+        reply_markup=topk_markup(gender_id, k, model_id, photo_id, multi),
+    )
+    await state.update_data({"multi": multi})
+
 
 @dp.callback_query(F.data == "launch")
 async def inline_launch(call: types.CallbackQuery, state: FSMContext):
@@ -199,6 +211,7 @@ async def inline_launch(call: types.CallbackQuery, state: FSMContext):
         k=data["k"],
         model_id=data["model_id"],
         photo_id=data["photo_id"],
+        multi=data.get("multi", False),
     )
 
 
@@ -215,83 +228,79 @@ async def handle_photo(message: types.Message, state: FSMContext):
     gender_id = data.get("gender")
     k = data.get("k")
     model_id = data.get("model_id")
+    multi = data.get("multi", False)
     photo_id = message.photo[-1].file_id
     await state.update_data({"photo_id": photo_id})
 
     if k is None or gender_id is None or model_id is None:
         await start_command(message, state)
     else:
-        await launch(message, gender_id, k, model_id, photo_id)
+        await launch(message, gender_id, k, model_id, photo_id, multi)
         # await state.update_data({"photo_id": None})
 
 
-async def launch(message: types.Message, gender_id, k, model_id, photo_id):
-    try:
-        if model_id == 0:
-            if gender_id == 0 and Loaded.male_lmdb_db is None:
-                logging.info("Loading MALE LMDB database...")
-                Loaded.male_lmdb_db = CelebDatabase(LMDB_PATH_MALE)
-
-                logging.info("Loading MALE FAISS index...")
-                Loaded.male_faiss_index = faiss.read_index(FAISS_PATH_MALE)
-            elif gender_id == 1 and Loaded.female_lmdb_db is None:
-                logging.info("Loading FEMALE LMDB database...")
-                Loaded.female_lmdb_db = CelebDatabase(LMDB_PATH_FEMALE)
-
-                logging.info("Loading FEMALE FAISS index...")
-                Loaded.female_faiss_index = faiss.read_index(FAISS_PATH_FEMALE)
-        elif model_id == 1:
-            # NNDB
-            if gender_id == 0 and Loaded.nndb_male_lmdb_db is None:
-                logging.info("Loading NNDB MALE LMDB database...")
-                Loaded.nndb_male_lmdb_db = CelebDatabase(NNDB_LMDB_PATH_MALE)
-
-                logging.info("Loading NNDB MALE FAISS index...")
-                Loaded.nndb_male_faiss_index = faiss.read_index(NNDB_FAISS_PATH_MALE)
-            elif gender_id == 1 and Loaded.nndb_female_lmdb_db is None:
-                logging.info("Loading NNDB FEMALE LMDB database...")
-                Loaded.nndb_female_lmdb_db = CelebDatabase(NNDB_LMDB_PATH_FEMALE)
-
-                logging.info("Loading NNDB FEMALE FAISS index...")
-                Loaded.nndb_female_faiss_index = faiss.read_index(NNDB_FAISS_PATH_FEMALE)
-
-        logging.info(f"Received a photo from the user. photo_id: {photo_id}")
-
-        photo_data = await bot.download(photo_id)
-        # await message.answer_photo(photo_id, "Ваше фото:")
-        face = await preprocess(photo_data)
-        embedding = await get_face_embedding(face)
-        if model_id == 0:
-            lmdb_database = Loaded.male_lmdb_db if gender_id == 0 else Loaded.female_lmdb_db
-            faiss_index = Loaded.male_faiss_index if gender_id == 0 else Loaded.female_faiss_index
-        else:
-            lmdb_database = Loaded.nndb_male_lmdb_db if gender_id == 0 else Loaded.nndb_female_lmdb_db
-            faiss_index = Loaded.nndb_male_faiss_index if gender_id == 0 else Loaded.nndb_female_faiss_index
-        results, distances = await find_closest(
-            embedding,
-            lmdb_database,
-            faiss_index,
-            k,
+async def send_result(message: types.Message, result, distance, prefix=""):
+    name = result["name"]
+    image = Image.open(io.BytesIO(result["photo"]))
+
+    with io.BytesIO() as buffer:
+        image.save(buffer, format="JPEG")
+        buffer.seek(0)
+        file_to_send = BufferedInputFile(buffer.getvalue(), "photo.jpg")
+
+        await message.answer_photo(
+            photo=file_to_send,
+            caption=f'{prefix}Схожесть с <a href="https://ya.ru/search/?text={name}">{name}</a> на {int(round(distance, 2) * 100)}%',
         )
 
+
+async def launch_multi(message: types.Message, photo_data, lmdb_database, faiss_index, model_name):
+    faces = await preprocess_all(photo_data)
+    if faces is None:
+        raise ValueError("На фото нет лица")
+    embeddings = await get_face_embeddings(faces, model_name) # все лица одним батчем
+    matches = await find_closest_batch(embeddings, lmdb_database, faiss_index, 1) # один поиск на все лица
+    sent = False
+    for i, (results, distances) in enumerate(matches, start=1):
         if results:
-            for result, distance in zip(results, distances):
-                name = result["name"]
-                image = Image.open(io.BytesIO(result["photo"]))
-
-                with io.BytesIO() as buffer:
-                    image.save(buffer, format="JPEG")
-                    buffer.seek(0)
-                    file_to_send = BufferedInputFile(buffer.getvalue(), "photo.jpg")
-
-                    await message.answer_photo(
-                        photo=file_to_send,
-                        caption=f'Схожесть с <a href="https://ya.ru/search/?text={name}">{name}</a> на {int(round(distance, 2) * 100)}%',
-                    )
-        else:
-            await message.answer(
-                "Не получилось найти похожее лицо. Попробуйте другое фото."
+            await send_result(message, results[0], distances[0], f"Лицо {i} из {len(matches)} (слева направо). ")
+            sent = True
+    if not sent:
+        await message.answer(
+            "Не получилось найти похожее лицо. Попробуйте другое фото."
+        )
+
+
+async def launch(message: types.Message, gender_id, k, model_id, photo_id, multi=False):
+    try:
+        # запрос держит текущее поколение баз до конца, даже если его подменят перезагрузкой
+        async with Loaded.use() as generation:
+            lmdb_database, faiss_index = await generation.get(model_id, gender_id)
+
+            logging.info(f"Received a photo from the user. photo_id: {photo_id}")
+
+            photo_data = await bot.download(photo_id)
+            # await message.answer_photo(photo_id, "Ваше фото:")
+            if multi:
+                await launch_multi(message, photo_data, lmdb_database, faiss_index, generation.model_name)
+                return
+
+            face = await preprocess(photo_data)
+            embedding = await get_face_embedding(face, generation.model_name)
+            results, distances = await find_closest(
+                embedding,
+                lmdb_database,
+                faiss_index,
+                k,
             )
+
+            if results:
+                for result, distance in zip(results, distances):
+                    await send_result(message, result, distance)
+            else:
+                await message.answer(
+                    "Не получилось найти похожее лицо. Попробуйте другое фото."
+                )
     except Exception as e:
         logging.error(f"Error processing photo: {e}", exc_info=True)
         await message.answer(
@@ -299,6 +308,27 @@ async def launch(message: types.Message, gender_id, k, model_id, photo_id):
         )
 
 
+@dp.message(Command("reload"))
+async def reload_command(message: types.Message, command: CommandObject):
+    if str(message.chat.id) != str(LOG_GROUP_ID): # перезагружать базы можно только из группы логов
+        return
+    version = command.args.strip() if command.args else None
+    try:
+        if version is not None:
+            check_version(version) # имя директории внутри artifacts, без '/' и '..'
+        await message.answer(f"Загружаем базы версии {version or 'из CURRENT'}...")
+        changed = await Loaded.reload(version)
+        if version is not None: # CURRENT меняем только после успешной загрузки, чтобы наблюдатель не откатил версию
+            set_current_version(version)
+        if changed:
+            await message.answer(f"Базы обновлены до версии {Loaded.active.version}")
+        else:
+            await message.answer(f"Версия {Loaded.active.version} уже загружена")
+    except Exception as e:
+        logging.error(f"Error reloading databases: {e}", exc_info=True)
+        await message.answer(f"Не удалось обновить базы: {html.escape(str(e))}")
+
+
 @dp.message()
 async def unknown_command(message: types.Message):
     message.answer("Неизвестная команда")
@@ -342,14 +372,15 @@ async def log_middleware(handler, event: types.Update, data):
 
 
 async def main():
+    watcher = asyncio.create_task(Loaded.watch(RELOAD_POLL_INTERVAL)) # подхватывает новые версии баз
     try:
         logging.info("Starting bot...")
         await dp.start_polling(bot)
     except Exception as e:
         logging.error(f"Error processing photo: {e}")
     finally:
-        # YOUR_CODE_HERE
-        pass
+        watcher.cancel()
+        await Loaded.close()
 
 
 if __name__ == "__main__":
@@ -13,3 +13,25 @@ NNDB_FAISS_PATH_FEMALE = 'nndb_data/faiss_index_female.bin'
 NNDB_FAISS_PATH_MALE = 'nndb_data/faiss_index_male.bin'
 
 DATASET_PATH = 'data'
+
+NNDB_DATASET_PATH = 'nndb_data'
+
+METADATA_CACHE_PATH = 'data/metadata'
+METADATA_BATCH_SIZE = 10000
+
+EMBEDDING_DIM = 512
+SHARD_SIZE = 50000  # строк эмбеддингов в одном шарде на диске
+BUILD_WORKERS = 8  # потоков детекции MTCNN
+BUILD_QUEUE_SIZE = 256
+EMBED_BATCH_SIZE = 64  # лиц в одном прямом проходе модели при сборке
+CENTROIDS_PER_CELEB = None  # None - вектор на каждое фото, N - до N центроидов на знаменитость
+SEARCH_OVERFETCH = 4  # во сколько раз больше кандидатов запрашивать для удаления повторов
+
+MULTI_FACE_THRESHOLD = 0.95  # минимальная уверенность MTCNN для лица на групповом фото
+MAX_FACES = 10
+
+ARTIFACTS_PATH = 'artifacts'  # artifacts/<версия>/ повторяет пути выше, artifacts/CURRENT - активная версия
+RELOAD_POLL_INTERVAL = 30  # секунд между проверками artifacts/CURRENT
+
+CROP_SHARD_SIZE = 10000  # кропов 3x160x160 uint8 в одном шарде (~770 МБ)
+REEMBED_BATCH_SIZE = 256
@@ -0,0 +1,103 @@
+import os
+import sys
+import shutil
+
+import asyncio
+import torch
+from tqdm import tqdm
+
+from config import CENTROIDS_PER_CELEB, REEMBED_BATCH_SIZE
+from utils.database import CelebDatabase
+from utils.face_embedding import get_face_embeddings, uint8_to_faces, FACE_SHAPE, MODELS
+from utils.generations import DATABASES, current_version, version_root, write_model_name
+from utils.pipeline import EmbeddingShards, GenderSink, crops_dir
+
+
+def photos_path(lmdb_path):
+    return lmdb_path + '_photos' if CENTROIDS_PER_CELEB else lmdb_path
+
+
+def has_crops(source_root, faiss_path):
+    return os.path.exists(os.path.join(source_root, crops_dir(faiss_path), 'manifest.json'))
+
+
+async def check_source(lmdb_path, source_root): # проверки до того, как что-то записано
+    source_photos = os.path.join(source_root, photos_path(lmdb_path))
+    if not os.path.isdir(source_photos):
+        if CENTROIDS_PER_CELEB and os.path.isdir(os.path.join(source_root, lmdb_path)):
+            raise FileNotFoundError(
+                f"'{source_photos}' not found: the source version was built without CENTROIDS_PER_CELEB. "
+                f"Rebuild it with CENTROIDS_PER_CELEB set or unset CENTROIDS_PER_CELEB."
+            )
+        raise FileNotFoundError(f"LMDB database '{source_photos}' not found.")
+    if CENTROIDS_PER_CELEB:
+        photos_db = CelebDatabase(source_photos, readonly=True)
+        names = await photos_db.read_names()
+        await photos_db.close()
+        if not names: # без names агрегация молча построит пустой индекс
+            raise ValueError(
+                f"'{source_photos}' has no names sub-database (built before it was added). "
+                f"Rebuild the source version with build.py."
+            )
+
+
+async def reembed_database(lmdb_path, faiss_path, source_root, target_root, model_name, dim):
+    source_crops = os.path.join(source_root, crops_dir(faiss_path))
+    crops = EmbeddingShards.open(source_crops)
+
+    # записи с фото не зависят от модели - копируем базу с отдельными фото как есть
+    photos = photos_path(lmdb_path)
+    target_photos = os.path.join(target_root, photos)
+    if not os.path.exists(target_photos):
+        shutil.copytree(os.path.join(source_root, photos), target_photos)
+
+    sink = GenderSink(os.path.join(target_root, lmdb_path), os.path.join(target_root, faiss_path),
+                      dim=dim, store_crops=False)
+    with tqdm(total=crops.count) as progress:
+        for shard in crops: # memory-mapped шарды кропов, без повторной детекции MTCNN
+            for start in range(0, len(shard), REEMBED_BATCH_SIZE):
+                batch = shard[start:start + REEMBED_BATCH_SIZE]
+                embeddings = await get_face_embeddings(uint8_to_faces(batch), model_name)
+                embeddings[~batch.any(axis=(1, 2, 3))] = 0 # фото без лица остаются нулевыми векторами
+                for embedding in embeddings:
+                    sink.shards.write(sink.shards.next_key(), embedding)
+                progress.update(len(batch))
+    await sink.close()
+    # ссылка на те же кропы, чтобы новую версию тоже можно было пересчитать другой моделью
+    target_crops = os.path.join(target_root, crops_dir(faiss_path))
+    if not os.path.exists(target_crops):
+        os.symlink(os.path.abspath(source_crops), target_crops)
+
+    print(f"\nCreating FAISS index '{sink.faiss_path}'...")
+    await sink.build_index()
+    print(f"FAISS index saved to '{sink.faiss_path}'")
+
+
+async def reembed(model_name, version=None):
+    # пересчитывает эмбеддинги из сохраненных кропов и кладет базы в новую версию artifacts/<version>
+    version = version or model_name
+    source_root = version_root(current_version())
+    target_root = version_root(version)
+    if os.path.abspath(source_root) == os.path.abspath(target_root):
+        raise ValueError(f"Версия '{version}' уже активна, выберите другую")
+
+    dim = (await get_face_embeddings(torch.zeros(1, *FACE_SHAPE), model_name)).shape[1]
+    databases = []
+    for lmdb_path, faiss_path in DATABASES.values():
+        if not has_crops(source_root, faiss_path):
+            print(f"No face crops for '{faiss_path}' in '{source_root}', skipping")
+            continue
+        await check_source(lmdb_path, source_root)
+        databases.append((lmdb_path, faiss_path))
+    for lmdb_path, faiss_path in databases:
+        await reembed_database(lmdb_path, faiss_path, source_root, target_root, model_name, dim)
+    os.makedirs(target_root, exist_ok=True)
+    write_model_name(target_root, model_name) # бот будет эмбеддить запросы к этой версии той же моделью
+    print(f"\nDone. Switch the bot to the new databases with '/reload {version}'")
+
+
+if __name__ == "__main__":
+    if not 2 <= len(sys.argv) <= 3:
+        print(f"Usage: python reembed.py <model> [version]  (models: {', '.join(MODELS)})")
+        sys.exit(1)
+    asyncio.run(reembed(*sys.argv[1:3]))
@@ -3,17 +3,43 @@ import lmdb
 
 
 class CelebDatabase:
-    def __init__(self, db_path):
-        self.env = lmdb.open(db_path, max_dbs=1, map_size=10 * 1024 * 1024 * 1024)
+    def __init__(self, db_path, readonly=False):
+        # readonly - для бота: отсутствующая база не создается пустой, а запись (в том числе open_db)
+        # не нужна, поэтому опубликованные версии можно держать на read-only разделе
+        self.env = lmdb.open(
+            db_path, max_dbs=1, map_size=10 * 1024 * 1024 * 1024,
+            readonly=readonly, create=not readonly, lock=not readonly, # версии после публикации не меняются
+        )
+        try:
+            self.names = self.env.open_db(b'names', create=not readonly) # ключ -> имя, без фото, для быстрой группировки
+        except lmdb.NotFoundError:
+            self.names = None # база собрана до появления names
 
     async def write_entry(self, key, data):
         with self.env.begin(write=True) as text:
             text.put(str(key).encode(), pickle.dumps(data))
+            if 'name' in data:
+                text.put(str(key).encode(), data['name'].encode(), db=self.names)
 
     async def read_entry(self, key):
         with self.env.begin() as text:
             data = text.get(str(key).encode())
             return pickle.loads(data) if data else None
 
+    async def read_name(self, key): # только имя, не распаковывая фото
+        if self.names is not None:
+            with self.env.begin() as text:
+                name = text.get(str(key).encode(), db=self.names)
+            if name is not None:
+                return name.decode()
+        entry = await self.read_entry(key) # база собрана до появления names
+        return entry["name"] if entry else None
+
+    async def read_names(self): # [(ключ, имя)] для всех записей, не распаковывая фото
+        if self.names is None:
+            return []
+        with self.env.begin(db=self.names) as text:
+            return [(int(key.decode()), name.decode()) for key, name in text.cursor()]
+
     async def close(self):
-        self.env.close()
\ No newline at end of file
+        self.env.close()
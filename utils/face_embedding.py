@@ -1,9 +1,14 @@
+import asyncio
 from facenet_pytorch import InceptionResnetV1, MTCNN
 from PIL import Image
+import numpy as np
 import torch
 
+from config import MULTI_FACE_THRESHOLD, MAX_FACES
+
 
 mtcnn = MTCNN()
+mtcnn_all = MTCNN(keep_all=True) # для групповых фото: все лица, а не только самое вероятное
 
 # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 # facenet_model = InceptionResnetV1(device=device)
@@ -14,23 +19,57 @@ mtcnn = MTCNN()
 
 facenet_model = InceptionResnetV1(pretrained="vggface2").eval()
 
-async def preprocess(image_path):
+FACE_SHAPE = (3, 160, 160) # выровненное лицо после MTCNN
+
+def face_to_uint8(face): # нормированное MTCNN лицо -> компактный uint8 кроп
+    return (face * 128 + 127.5).round().clamp(0, 255).to(torch.uint8).numpy()
+
+def uint8_to_faces(crops): # батч uint8 кропов -> тензор, как после MTCNN (fixed_image_standardization)
+    return (torch.from_numpy(np.ascontiguousarray(crops)).float() - 127.5) / 128
+
+# детекция и модели тяжелые для CPU, поэтому async-обертки запускают их в отдельном потоке,
+# чтобы не блокировать event loop и давать нескольким корутинам работать параллельно
+
+def _detect(image_path):
     image = Image.open(image_path).convert("RGB")
     face = mtcnn(image)
     return face
 
-async def get_facenet_embedding(face):
-    if face is None:
-        raise ValueError(f"На фото нет лица")
+async def preprocess(image_path):
+    return await asyncio.to_thread(_detect, image_path)
+
+def _detect_all(image_path, threshold, max_faces):
+    image = Image.open(image_path).convert("RGB")
+    boxes, probs = mtcnn_all.detect(image)
+    if boxes is None:
+        return None
+    boxes = boxes[probs >= threshold]
+    boxes = boxes[np.argsort(-probs[probs >= threshold])[:max_faces]] # самые уверенные лица
+    if len(boxes) == 0:
+        return None
+    boxes = boxes[np.argsort(boxes[:, 0])] # по горизонтали, чтобы нумерация совпадала с фото
+    return mtcnn_all.extract(image, boxes, None)
+
+async def preprocess_all(image_path, threshold=MULTI_FACE_THRESHOLD, max_faces=MAX_FACES):
+    # все лица с уверенностью не ниже threshold, слева направо: тензор (N, 3, 160, 160) или None
+    return await asyncio.to_thread(_detect_all, image_path, threshold, max_faces)
+
+def get_facenet_embeddings(faces):
     with torch.no_grad():
-        embedding = facenet_model(face.unsqueeze(0))
-    return embedding.squeeze().numpy()
+        embeddings = facenet_model(faces) # один прямой проход на весь батч
+    return embeddings.numpy()
 
 MODELS = {
-    "facenet": get_facenet_embedding
+    "facenet": get_facenet_embeddings
 }
 
-async def get_face_embedding(face, model_name = "facenet"):
+async def get_face_embeddings(faces, model_name = "facenet"):
     if model_name not in MODELS:
         raise ValueError(f"Модель '{model_name}' не поддерживается. Поддерживаемые модели: {list(MODELS.keys())}")
-    return await MODELS[model_name](face)
\ No newline at end of file
+    return await asyncio.to_thread(MODELS[model_name], faces)
+
+async def get_face_embedding(face, model_name = "facenet"):
+    if face is None:
+        raise ValueError(f"На фото нет лица")
+    embeddings = await get_face_embeddings(face.unsqueeze(0), model_name)
+    return embeddings[0]
@@ -0,0 +1,172 @@
+import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import faiss
+
+from utils.database import CelebDatabase
+from config import (
+    LMDB_PATH_MALE, LMDB_PATH_FEMALE, FAISS_PATH_MALE, FAISS_PATH_FEMALE,
+    NNDB_LMDB_PATH_MALE, NNDB_LMDB_PATH_FEMALE, NNDB_FAISS_PATH_MALE, NNDB_FAISS_PATH_FEMALE,
+    ARTIFACTS_PATH,
+)
+
+
+DATABASES = { # (model_id, gender_id) -> (lmdb, faiss) относительно корня поколения
+    (0, 0): (LMDB_PATH_MALE, FAISS_PATH_MALE),
+    (0, 1): (LMDB_PATH_FEMALE, FAISS_PATH_FEMALE),
+    (1, 0): (NNDB_LMDB_PATH_MALE, NNDB_FAISS_PATH_MALE),
+    (1, 1): (NNDB_LMDB_PATH_FEMALE, NNDB_FAISS_PATH_FEMALE),
+}
+CURRENT_FILE = os.path.join(ARTIFACTS_PATH, 'CURRENT')
+MODEL_FILE = 'MODEL' # artifacts/<версия>/MODEL - модель из MODELS, которой построены индексы
+DEFAULT_MODEL = "facenet"
+
+
+def current_version(): # активная версия из artifacts/CURRENT, None - артефакты лежат по путям из config
+    if not os.path.exists(CURRENT_FILE):
+        return None
+    with open(CURRENT_FILE) as f:
+        return f.read().strip() or None
+
+
+def check_version(version): # версия - имя одной директории внутри artifacts, без выхода за ее пределы
+    if not version or version == '.' or '..' in version or '/' in version or '\\' in version:
+        raise ValueError(f"Некорректное имя версии: '{version}'")
+    return version
+
+
+def version_root(version): # корень поколения: artifacts/<версия> или текущая директория
+    return '.' if version is None else os.path.join(ARTIFACTS_PATH, check_version(version))
+
+
+def read_model_name(root): # модель поколения; без файла MODEL - сборка build.py моделью по умолчанию
+    path = os.path.join(root, MODEL_FILE)
+    if not os.path.exists(path):
+        return DEFAULT_MODEL
+    with open(path) as f:
+        return f.read().strip() or DEFAULT_MODEL
+
+
+def write_model_name(root, model_name):
+    with open(os.path.join(root, MODEL_FILE), 'w') as f:
+        f.write(model_name)
+
+
+def set_current_version(version):
+    root = version_root(version)
+    if not os.path.isdir(root):
+        raise FileNotFoundError(f"Artifacts directory '{root}' not found.")
+    tmp_path = CURRENT_FILE + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(version)
+    os.replace(tmp_path, CURRENT_FILE) # атомарная замена
+
+
+def new_version(): # имя версии для новой сборки
+    return datetime.now().strftime('%Y%m%d-%H%M%S')
+
+
+def publish_version(version, model_name=DEFAULT_MODEL): # вызывается, когда сборка версии закончена
+    write_model_name(version_root(version), model_name)
+    if current_version() is None: # первая сборка - сразу делаем ее активной
+        set_current_version(version)
+        print(f"\nVersion {version} is now active")
+    else:
+        print(f"\nDone. Switch the bot to the new databases with '/reload {version}'")
+
+
+class Generation: # одно поколение баз: lmdb и faiss индексы одной сборки
+    def __init__(self, version):
+        self.version = version
+        self.root = version_root(version)
+        self.model_name = read_model_name(self.root) # запросы эмбеддим той же моделью, что и индекс
+        self.databases = {}
+        self.users = 0 # сколько запросов сейчас используют поколение
+        self.retired = False
+        self._lock = asyncio.Lock()
+
+    def _load(self, key):
+        lmdb_path, faiss_path = DATABASES[key]
+        logging.info(f"Loading LMDB database '{lmdb_path}' (version {self.version})...")
+        lmdb_db = CelebDatabase(os.path.join(self.root, lmdb_path), readonly=True)
+        logging.info(f"Loading FAISS index '{faiss_path}' (version {self.version})...")
+        return lmdb_db, faiss.read_index(os.path.join(self.root, faiss_path))
+
+    async def get(self, model_id, gender_id): # загружает базу при первом обращении
+        key = (model_id, gender_id)
+        async with self._lock:
+            if key not in self.databases:
+                self.databases[key] = await asyncio.to_thread(self._load, key)
+        return self.databases[key]
+
+    async def preload(self): # загружает все базы, которые есть в поколении
+        for key, (lmdb_path, faiss_path) in DATABASES.items():
+            if os.path.exists(os.path.join(self.root, faiss_path)):
+                if not os.path.isdir(os.path.join(self.root, lmdb_path)): # индекс без базы - версия битая
+                    raise FileNotFoundError(f"LMDB database '{os.path.join(self.root, lmdb_path)}' not found.")
+                await self.get(*key)
+        if not self.databases:
+            raise FileNotFoundError(f"No FAISS indexes found in '{self.root}'.")
+
+    async def close(self):
+        logging.info(f"Closing databases (version {self.version})...")
+        for lmdb_db, _ in self.databases.values():
+            await lmdb_db.close()
+        self.databases.clear()
+
+
+class Generations: # активное поколение и его горячая замена
+    def __init__(self):
+        self.active = Generation(current_version())
+        self._reload_lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def use(self): # запрос держит поколение, пока не закончится
+        generation = self.active
+        generation.users += 1
+        try:
+            yield generation
+        finally:
+            generation.users -= 1
+            if generation.retired and generation.users == 0:
+                await generation.close()
+
+    async def reload(self, version=None): # загружает новое поколение в фоне и подменяет активное
+        async with self._reload_lock:
+            version = version or current_version()
+            if version == self.active.version:
+                return False
+            generation = Generation(version)
+            try:
+                await generation.preload()
+            except Exception:
+                await generation.close() # не оставляем открытыми уже загруженные lmdb базы
+                raise
+
+            old, self.active = self.active, generation # новые запросы сразу идут в новое поколение
+            old.retired = True
+            if old.users == 0: # иначе закроет последний запрос в use()
+                await old.close()
+            logging.info(f"Switched databases from version {old.version} to {version}")
+            return True
+
+    async def watch(self, interval): # следит за artifacts/CURRENT
+        failed = None # (версия, mtime CURRENT) последней неудачной загрузки
+        while True:
+            await asyncio.sleep(interval)
+            mtime = os.path.getmtime(CURRENT_FILE) if os.path.exists(CURRENT_FILE) else None
+            state = (current_version(), mtime)
+            if state == failed: # битую версию не перечитываем, пока CURRENT не изменится
+                continue
+            try:
+                await self.reload(state[0])
+                failed = None
+            except Exception as e:
+                failed = state
+                logging.error(f"Error reloading databases (version {state[0]}), waiting for CURRENT to change: {e}", exc_info=True)
+
+    async def close(self):
+        await self.active.close()
@@ -0,0 +1,116 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import scipy.io
+
+from config import DATASET_PATH, NNDB_DATASET_PATH, METADATA_CACHE_PATH, METADATA_BATCH_SIZE
+
+
+MATLAB_UNIX_EPOCH = 719529  # datenum для 1970-01-01
+MATLAB_MAX_DATENUM = 3652059  # datenum для 9999-12-31
+
+
+def _cellstr(cells): # matlab cell-массив строк -> numpy массив строк ('' для пустых ячеек)
+    sizes = np.fromiter((c.size for c in cells), dtype=np.int64, count=len(cells))
+    result = np.full(len(cells), '', dtype=object)
+    if (sizes > 0).any():
+        result[sizes > 0] = np.concatenate(cells[sizes > 0])
+    return result
+
+
+def _matlab_datenum_to_datetime(datenum): # векторное преобразование matlab datenum в даты
+    datenum = np.asarray(datenum, dtype=np.float64)
+    valid = (datenum > 0) & (datenum < MATLAB_MAX_DATENUM)
+    days = np.where(valid, np.floor(datenum) - MATLAB_UNIX_EPOCH, 0).astype(np.int64)
+    dates = days.astype('datetime64[D]')
+    dates[~valid] = np.datetime64('NaT')
+    return dates
+
+
+def _parse_imdb_mat(source_path):
+    dt = scipy.io.loadmat(source_path)['imdb'][0, 0] # загрузка базы данных
+    keys_s = ('gender', 'dob', 'photo_taken',
+              'face_score', 'second_face_score', 'celeb_id')
+    values = {k: dt[k].squeeze() for k in keys_s}
+    values['full_path'] = _cellstr(dt['full_path'][0])
+    values['name'] = _cellstr(dt['name'][0])
+    # местоположение лица храним отдельными колонками, чтобы таблица оставалась колоночной
+    face_location = np.vstack(dt['face_location'].squeeze()).astype(np.float32)
+    for i, k in enumerate(('face_x1', 'face_y1', 'face_x2', 'face_y2')):
+        values[k] = face_location[:, i]
+
+    set_nrows = {len(v) for _, v in values.items()} # убедимся, что все массивы имеют одну длину:
+    assert len(set_nrows) == 1
+
+    df = pd.DataFrame(values)
+    df['dob'] = _matlab_datenum_to_datetime(df['dob'].values)
+    return df
+
+
+def _parse_imdb_csv(source_path):
+    df = pd.read_csv(source_path, usecols=[2, 8, 9], dtype=str, keep_default_na=False)
+    df.columns = ['gender', 'path', 'name'] # usecols сохраняет порядок колонок в файле
+    df['gender'] = pd.to_numeric(df['gender'], errors='coerce')
+    return df[['path', 'name', 'gender']]
+
+
+def _parse_nndb_csv(source_path):
+    df = pd.read_csv(source_path, sep=';', usecols=[0, 1, 3], dtype=str, keep_default_na=False)
+    df.columns = ['name', 'gender', 'path']
+    df['gender'] = np.where(df['gender'] == 'Female', 0.0, 1.0)
+    df['path'] = NNDB_DATASET_PATH + "/" + df['path']
+    return df[['path', 'name', 'gender']]
+
+
+SOURCES = { # имя источника -> (путь к исходному файлу, парсер, версия схемы)
+    # версию схемы нужно увеличивать при любом изменении колонок парсера - старый кэш перестанет читаться
+    'imdb_mat': (os.path.join(DATASET_PATH, 'imdb_crop/imdb.mat'), _parse_imdb_mat, 1),
+    'imdb_csv': (os.path.join(DATASET_PATH, 'out.csv'), _parse_imdb_csv, 1),
+    'nndb_csv': (os.path.join(NNDB_DATASET_PATH, 'data_with_paths.csv'), _parse_nndb_csv, 1),
+}
+
+
+def cache_path(source):
+    version = SOURCES[source][2]
+    return os.path.join(METADATA_CACHE_PATH, f'{source}.v{version}.parquet')
+
+
+def ingest(source, force=False): # парсит источник и кладет очищенную таблицу в parquet-кэш
+    if source not in SOURCES:
+        raise ValueError(f"Источник '{source}' не поддерживается. Поддерживаемые источники: {list(SOURCES.keys())}")
+    source_path, parse, _ = SOURCES[source]
+    path = cache_path(source)
+    if not force and os.path.exists(path):
+        if not os.path.exists(source_path): # исходника нет (например, датасет удален) - работаем по кэшу
+            return path
+        if os.path.getmtime(path) >= os.path.getmtime(source_path):
+            return path # кэш свежее исходника
+
+    df = parse(source_path)
+    os.makedirs(METADATA_CACHE_PATH, exist_ok=True)
+    tmp_path = path + '.tmp'
+    df.to_parquet(tmp_path, index=False, row_group_size=METADATA_BATCH_SIZE)
+    os.replace(tmp_path, path) # атомарная замена, чтобы не оставить битый кэш
+    return path
+
+
+def load_metadata(source, columns=None):
+    return pd.read_parquet(ingest(source), columns=columns)
+
+
+def iter_metadata(source, columns=None, batch_size=METADATA_BATCH_SIZE): # потоковое чтение кэша кусками
+    parquet_file = pq.ParquetFile(ingest(source))
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        yield batch.to_pandas()
+
+
+def best_images(df): # лучшая фотография каждого человека
+    # фото без пола не попадают ни в мужской, ни в женский индекс
+    filtered_df = df[(df['face_score'] > 0) & (df['second_face_score'].isna()) & (df['gender'].notna())]
+    best = ( # сортировка по счету лица и даты фото:
+        filtered_df.sort_values(by=['face_score', 'photo_taken'], ascending=[False, False])
+        .drop_duplicates('celeb_id')
+    )
+    return best.rename(columns={'full_path': 'path'})
+
@@ -0,0 +1,250 @@
+import os
+import json
+import numpy as np
+
+import asyncio
+from tqdm import tqdm
+
+import faiss
+import torch
+
+from utils.database import CelebDatabase
+from utils.face_embedding import preprocess, get_face_embeddings, face_to_uint8, FACE_SHAPE
+from config import EMBEDDING_DIM, SHARD_SIZE, CROP_SHARD_SIZE, BUILD_WORKERS, BUILD_QUEUE_SIZE, EMBED_BATCH_SIZE, CENTROIDS_PER_CELEB
+
+
+class EmbeddingShards: # эмбеддинги float32 на диске, разбитые на шарды по SHARD_SIZE строк
+    def __init__(self, shard_dir, dim=EMBEDDING_DIM, shard_size=SHARD_SIZE, dtype=np.float32):
+        # dim - длина эмбеддинга или форма строки (например, (3, 160, 160) для кропов лиц)
+        self.shard_dir = shard_dir
+        self.dim = dim
+        self.row_shape = tuple(dim) if isinstance(dim, (tuple, list)) else (dim,)
+        self.dtype = np.dtype(dtype)
+        self.shard_size = shard_size
+        self.count = 0
+        self._open = {} # номер шарда -> (memmap, сколько строк записано)
+        os.makedirs(shard_dir, exist_ok=True)
+
+    @classmethod
+    def open(cls, shard_dir): # открыть уже собранные шарды на чтение
+        with open(os.path.join(shard_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+        dim = tuple(manifest['dim']) if isinstance(manifest['dim'], list) else manifest['dim']
+        shards = cls(shard_dir, dim, manifest['shard_size'], manifest.get('dtype', 'float32'))
+        shards.count = manifest['count']
+        return shards
+
+    def _shard_path(self, shard_id):
+        return os.path.join(self.shard_dir, f'shard_{shard_id:05d}.npy')
+
+    def next_key(self):
+        key = self.count
+        self.count += 1
+        return key
+
+    def write(self, key, embedding):
+        shard_id, row = divmod(key, self.shard_size)
+        if shard_id not in self._open: # новый шард заполнен нулями - неудачные фото остаются нулевыми векторами
+            shard = np.lib.format.open_memmap(
+                self._shard_path(shard_id), mode='w+', dtype=self.dtype, shape=(self.shard_size, *self.row_shape)
+            )
+            self._open[shard_id] = [shard, 0]
+        entry = self._open[shard_id]
+        if embedding is not None:
+            entry[0][row] = embedding
+        entry[1] += 1
+        if entry[1] == self.shard_size: # шард заполнен - сбрасываем на диск и освобождаем память
+            entry[0].flush()
+            del self._open[shard_id]
+
+    def close(self):
+        for shard, _ in self._open.values():
+            shard.flush()
+        self._open.clear()
+        with open(os.path.join(self.shard_dir, 'manifest.json'), 'w') as f:
+            json.dump({'dim': self.dim, 'shard_size': self.shard_size, 'count': self.count, 'dtype': self.dtype.name}, f)
+
+    def take(self, keys): # эмбеддинги по списку ключей
+        keys = np.asarray(keys)
+        result = np.empty((len(keys), *self.row_shape), dtype=self.dtype)
+        for shard_id in np.unique(keys // self.shard_size):
+            mask = keys // self.shard_size == shard_id
+            shard = np.load(self._shard_path(shard_id), mmap_mode='r')
+            result[mask] = shard[keys[mask] % self.shard_size]
+        return result
+
+    def __iter__(self): # memory-mapped шарды по порядку ключей
+        for start in range(0, self.count, self.shard_size):
+            shard = np.load(self._shard_path(start // self.shard_size), mmap_mode='r')
+            yield shard[:min(self.shard_size, self.count - start)]
+
+    def build_index(self, faiss_path):
+        index = faiss.IndexFlatIP(self.dim)
+        for shard in self: # добавляем по шарду, не собирая все эмбеддинги в памяти
+            index.add(np.ascontiguousarray(shard))
+        faiss.write_index(index, faiss_path) # сохранение index по пути faiss_path
+        return index
+
+
+def crops_dir(faiss_path): # выровненные кропы лиц лежат рядом с индексом
+    return os.path.splitext(faiss_path)[0] + '_crops'
+
+
+class GenderSink: # lmdb база и шарды эмбеддингов для одного пола
+    def __init__(self, lmdb_path, faiss_path, centroids=CENTROIDS_PER_CELEB, dim=EMBEDDING_DIM, store_crops=True):
+        # при агрегации по знаменитостям отдельные фото пишутся в соседнюю базу,
+        # а по lmdb_path и faiss_path сохраняются центроиды
+        self.lmdb_path = lmdb_path
+        self.faiss_path = faiss_path
+        self.centroids = centroids
+        self.photos_path = lmdb_path + '_photos' if centroids else lmdb_path
+        if not os.path.exists(self.photos_path): # создает каталог, если его нет
+            os.makedirs(self.photos_path)
+        self.lmdb_db = CelebDatabase(self.photos_path)
+        self.shards = EmbeddingShards(os.path.splitext(faiss_path)[0] + '_shards', dim)
+        # кропы uint8 позволяют пересчитать эмбеддинги другой моделью без повторной детекции (см. reembed.py)
+        self.crops = EmbeddingShards(crops_dir(faiss_path), FACE_SHAPE, CROP_SHARD_SIZE, np.uint8) if store_crops else None
+
+    async def close(self):
+        self.shards.close()
+        if self.crops is not None:
+            self.crops.count = self.shards.count # у кропов те же ключи, что и у эмбеддингов
+            self.crops.close()
+        await self.lmdb_db.close() # закрывает файл
+
+    async def build_index(self):
+        if self.centroids:
+            await aggregate_by_name(self)
+        else:
+            self.shards.build_index(self.faiss_path)
+
+
+def celeb_centroids(embeddings, k): # один или несколько нормированных центроидов эмбеддингов знаменитости
+    if k == 1 or len(embeddings) <= k:
+        centroids = embeddings.mean(axis=0, keepdims=True) if k == 1 else embeddings
+    else:
+        kmeans = faiss.Kmeans(embeddings.shape[1], k, niter=20, spherical=True)
+        kmeans.train(embeddings)
+        centroids = kmeans.centroids
+    norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+    return centroids / np.maximum(norms, 1e-12)
+
+
+async def aggregate_by_name(sink): # индекс из центроидов: один или несколько векторов на знаменитость
+    photos_db = CelebDatabase(sink.photos_path)
+    keys_by_name = {}
+    for key, name in sorted(await photos_db.read_names()): # неудачные фото в базу не попали
+        keys_by_name.setdefault(name, []).append(key)
+
+    if not os.path.exists(sink.lmdb_path): # создает каталог, если его нет
+        os.makedirs(sink.lmdb_path)
+    celeb_db = CelebDatabase(sink.lmdb_path)
+    centroid_shards = EmbeddingShards(os.path.splitext(sink.faiss_path)[0] + '_centroid_shards', sink.shards.dim)
+    for name, keys in tqdm(keys_by_name.items()):
+        embeddings = sink.shards.take(keys)
+        for centroid in celeb_centroids(embeddings, sink.centroids):
+            best_key = keys[int(np.argmax(embeddings @ centroid))] # фото, ближайшее к центроиду, показываем пользователю
+            best_entry = await photos_db.read_entry(best_key)
+            key = centroid_shards.next_key()
+            await celeb_db.write_entry(key, {
+                'name': name,
+                'embedding': centroid.tolist(),
+                'photo': best_entry['photo'],
+                'photo_keys': keys, # все фото знаменитости в базе photos_path
+            })
+            centroid_shards.write(key, centroid)
+    centroid_shards.close()
+    await celeb_db.close()
+    await photos_db.close()
+    centroid_shards.build_index(sink.faiss_path)
+
+
+def _read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+async def detect_face(image_path): # выровненное лицо и байты фото или (None, None)
+    if not image_path.lower().endswith(('.png', '.jpg', '.jpeg')):
+        return None, None
+
+    try:
+        face = await preprocess(image_path)
+        if face is None:
+            raise ValueError("На фото нет лица")
+        photo_bytes = await asyncio.to_thread(_read_bytes, image_path) # прочитали фото в бинарном формате
+        return face, photo_bytes
+    except Exception as e:
+        print(f"Error processing {image_path}: {e}")
+        return None, None
+
+
+async def embed_batch(batch): # один прямой проход модели на батч лиц, затем запись в базы и шарды
+    found = [item for item in batch if item[3] is not None]
+    embeddings = await get_face_embeddings(torch.stack([item[3] for item in found])) if found else []
+    for (sink, key, name, face, photo_bytes), embedding in zip(found, embeddings):
+        data = { # словарь с нужными параметрами: имя, ембеддинги и фото
+            'name': name,
+            'embedding': embedding.tolist(),
+            'photo': photo_bytes,
+        }
+        await sink.lmdb_db.write_entry(key, data) # записываем в датабазу
+        sink.shards.write(key, embedding)
+        if sink.crops is not None:
+            sink.crops.write(key, face_to_uint8(face))
+    for sink, key, _, face, _ in batch:
+        if face is None: # неудачные фото остаются нулевыми строками
+            sink.shards.write(key, None)
+            if sink.crops is not None:
+                sink.crops.write(key, None)
+
+
+async def stream_build(chunks, female, male, image_root, workers=BUILD_WORKERS, queue_size=BUILD_QUEUE_SIZE,
+                       batch_size=EMBED_BATCH_SIZE, total=None):
+    # chunks - итератор DataFrame с колонками path, name, gender (см. utils.metadata.iter_metadata)
+    # метаданные -> детекция (workers потоков) -> батчевый эмбеддинг и запись;
+    # между стадиями ограниченные очереди, поэтому память не растет с размером датасета
+    paths = asyncio.Queue(maxsize=queue_size)
+    faces = asyncio.Queue(maxsize=queue_size)
+    progress = tqdm(total=total)
+
+    async def produce():
+        for chunk in chunks:
+            for path, name, gender in zip(chunk['path'].values, chunk['name'].values, chunk['gender'].values):
+                sink = female if gender == 0 else male
+                await paths.put((sink, sink.shards.next_key(), path, name))
+        for _ in range(workers):
+            await paths.put(None)
+
+    async def detect():
+        while (item := await paths.get()) is not None:
+            sink, key, path, name = item
+            face, photo_bytes = await detect_face(os.path.join(image_root, path))
+            await faces.put((sink, key, name, face, photo_bytes))
+
+    async def detect_all():
+        await asyncio.gather(*(detect() for _ in range(workers)))
+        await faces.put(None) # все детекторы закончили
+
+    async def embed():
+        done = False
+        while not done:
+            batch = [await faces.get()]
+            while len(batch) < batch_size and not faces.empty(): # добираем батч из того, что уже готово
+                batch.append(faces.get_nowait())
+            if batch[-1] is None:
+                batch.pop()
+                done = True
+            if batch:
+                await embed_batch(batch)
+                progress.update(len(batch))
+
+    await asyncio.gather(produce(), detect_all(), embed())
+    progress.close()
+    await female.close()
+    await male.close()
+
+    for title, sink in (('female', female), ('male', male)):
+        print(f"\nCreating FAISS index for {title}...")
+        await sink.build_index()
+        print(f"FAISS index for {title} saved to '{sink.faiss_path}'")
@@ -1,10 +1,58 @@
 import numpy as np
 
+from config import SEARCH_OVERFETCH
 
-async def find_closest(embedding, lmdb_database, faiss_index, k=1):
-     distances, result_idx = faiss_index.search(np.array([embedding]), k) # поиск ближайших k фотографий
-     distances = distances[0].tolist()  # косинусное расстояние до найденных фото
-     closest_entries = [] # имена похожих знаменитостей:
-     for key in result_idx[0]:
-        closest_entries.append(await lmdb_database.read_entry(key))
-     return closest_entries, distances
\ No newline at end of file
+
+async def _accept(result_idx, distances, lmdb_database, k, unique, accepted, seen_names):
+     # отбирает ключи кандидатов по одному только имени, фото при этом не читаются
+     for key, distance in zip(result_idx, distances.tolist()):
+        if key < 0 or len(accepted) == k: # faiss возвращает -1, если кандидатов меньше, чем запрошено
+            break
+        if unique:
+            name = await lmdb_database.read_name(key)
+            if name is None or name in seen_names: # одна знаменитость - один ответ
+                continue
+            seen_names.add(name)
+        accepted.append((key, distance))
+
+
+async def _read_accepted(accepted, lmdb_database):
+     closest_entries = [] # похожие знаменитости:
+     closest_distances = [] # косинусное расстояние до найденных фото
+     for key, distance in accepted: # полные записи с фото читаем только для k ответов
+        entry = await lmdb_database.read_entry(key)
+        if entry is not None:
+            closest_entries.append(entry)
+            closest_distances.append(distance)
+     return closest_entries, closest_distances
+
+
+async def find_closest(embedding, lmdb_database, faiss_index, k=1, unique=True):
+     query = np.array([embedding], dtype=np.float32)
+     fetch = k * SEARCH_OVERFETCH if unique else k # с запасом, чтобы после удаления повторов осталось k
+     accepted, seen_names, scanned = [], set(), 0
+     while True:
+        fetch = min(fetch, faiss_index.ntotal)
+        distances, result_idx = faiss_index.search(query, fetch) # поиск ближайших фотографий
+        # продолжаем с места, где остановились в прошлый раз, а не с начала выдачи
+        await _accept(result_idx[0][scanned:], distances[0][scanned:], lmdb_database, k, unique, accepted, seen_names)
+        scanned = fetch
+        if len(accepted) == k or fetch >= faiss_index.ntotal:
+            return await _read_accepted(accepted, lmdb_database)
+        fetch *= 2 # повторов оказалось слишком много - расширяем поиск
+
+
+async def find_closest_batch(embeddings, lmdb_database, faiss_index, k=1, unique=True):
+     # один поиск faiss на все лица с фото; возвращает список (entries, distances) на каждое лицо
+     query = np.asarray(embeddings, dtype=np.float32)
+     fetch = min(k * SEARCH_OVERFETCH if unique else k, faiss_index.ntotal)
+     distances, result_idx = faiss_index.search(query, fetch)
+     results = []
+     for i in range(len(query)):
+        accepted = []
+        await _accept(result_idx[i], distances[i], lmdb_database, k, unique, accepted, set())
+        if len(accepted) < k and fetch < faiss_index.ntotal: # редкий случай: не хватило разных людей
+            results.append(await find_closest(query[i], lmdb_database, faiss_index, k, unique))
+        else:
+            results.append(await _read_accepted(accepted, lmdb_database))
+     return results